@@ -1,24 +1,40 @@
 import dataclasses
 import datetime
+import functools
 from collections.abc import Iterable
 from typing import Self
 
-KNOWN_B2F_HEADERS = [
-    "mid",
-    "date",
-    "type",
-    "from",
-    "to",
-    "cc",
-    "subject",
-    "mbo",
-    "body",
-    "file",
-]
+KNOWN_B2F_HEADERS = frozenset(
+    [
+        "mid",
+        "date",
+        "type",
+        "from",
+        "to",
+        "cc",
+        "subject",
+        "mbo",
+        "body",
+        "file",
+    ]
+)
 
 B2F_DATE_FORMAT = "%Y/%m/%d %H:%M"
 
 
+# dates only have minute resolution, so many messages in a mailbox share one
+@functools.lru_cache(maxsize=1 << 16)
+def parse_b2f_date(date: str) -> datetime.datetime:
+    return datetime.datetime.strptime(date, B2F_DATE_FORMAT)
+
+
+def format_b2f_date(date: datetime.datetime) -> str:
+    # equivalent to date.strftime(B2F_DATE_FORMAT), without strftime's overhead
+    return (
+        f"{date.year:04}/{date.month:02}/{date.day:02} {date.hour:02}:{date.minute:02}"
+    )
+
+
 @dataclasses.dataclass
 class B2FMessage:
     mid: str
@@ -35,84 +51,41 @@ class B2FMessage:
 
     @classmethod
     def parse(cls, data: bytes) -> Self:
-        header_data, _, contents = data.partition(b"\r\n\r\n")
-
-        headers: dict[str, list[str]] = {}
-        for line in header_data.decode("ascii").splitlines():
-            k, _, v = line.partition(": ")
-            if k in headers:
-                headers[k].append(v)
-            else:
-                headers[k] = [v]
-
-        casefolded_headers = {k.casefold(): v for k, v in headers.items()}
-
-        def get_single_header(name: str) -> str:
-            header = casefolded_headers[name.casefold()]
-            assert len(header) == 1
-            return header[0]
-
-        body_length = int(get_single_header("body"))
-        content_type = (
-            get_single_header("content-type")
-            if "content-type" in casefolded_headers
-            else "iso-8859-1"
-        )
-        body = contents[:body_length].decode(content_type)
-
-        # files are separated by "\r\n" (2 bytes)
-        file_offset = int(body_length) + 2
-        files = []
-        for file_entry in casefolded_headers.get("file", []):
-            file_len, _, file_name = file_entry.partition(" ")
-            file_end = file_offset + int(file_len)
-            files.append((file_name, contents[file_offset:file_end]))
-            file_offset = file_end + 2
-
-        extra_headers = {
-            k: v for k, v in headers.items() if k.casefold() not in KNOWN_B2F_HEADERS
-        }
-
+        message = LazyB2FMessage(data)
         return cls(
-            mid=get_single_header("mid"),
-            date=datetime.datetime.strptime(get_single_header("date"), B2F_DATE_FORMAT),
-            type=get_single_header("type") if "type" in casefolded_headers else None,
-            from_=get_single_header("from"),
-            to=casefolded_headers["to"],
-            cc=casefolded_headers.get("cc", []),
-            subject=get_single_header("subject"),
-            mbo=get_single_header("mbo"),
-            extra_headers=extra_headers,
-            body=body,
-            files=files,
+            mid=message.mid,
+            date=message.date,
+            type=message.type,
+            from_=message.from_,
+            to=message.to,
+            cc=message.cc,
+            subject=message.subject,
+            mbo=message.mbo,
+            extra_headers=message.extra_headers,
+            body=message.body,
+            files=[(name, bytes(contents)) for name, contents in message.files],
         )
 
     def to_lines(self) -> Iterable[bytes]:
         body = self.body.encode("ascii")
 
-        headers = {
-            "Mid": self.mid,
-            "Date": self.date.strftime(B2F_DATE_FORMAT),
-            "Type": self.type,
-            "From": self.from_,
-            "To": self.to,
-            "Cc": self.cc,
-            "Subject": self.subject,
-            "Mbo": self.mbo,
-            "Body": len(body),
-            "File": [
-                f"{len(contents)} {file_name}" for file_name, contents in self.files
-            ],
-            **self.extra_headers,
-        }
-        if headers["Type"] is None:
-            del headers["Type"]
-        for header_name, values in headers.items():
-            if isinstance(values, list):
-                for value in values:
-                    yield f"{header_name}: {value}".encode("ascii")
-            else:
-                yield f"{header_name}: {values}".encode("ascii")
+        yield f"Mid: {self.mid}".encode("ascii")
+        yield f"Date: {format_b2f_date(self.date)}".encode("ascii")
+        if self.type is not None:
+            yield f"Type: {self.type}".encode("ascii")
+        yield f"From: {self.from_}".encode("ascii")
+        for to in self.to:
+            yield f"To: {to}".encode("ascii")
+        for cc in self.cc:
+            yield f"Cc: {cc}".encode("ascii")
+        yield f"Subject: {self.subject}".encode("ascii")
+        yield f"Mbo: {self.mbo}".encode("ascii")
+        yield f"Body: {len(body)}".encode("ascii")
+        for file_name, contents in self.files:
+            yield f"File: {len(contents)} {file_name}".encode("ascii")
+        for header_name, values in self.extra_headers.items():
+            for value in values:
+                yield f"{header_name}: {value}".encode("ascii")
 
         yield b"\r\n"
         yield body
@@ -122,3 +95,103 @@ class B2FMessage:
 
     def to_bytes(self) -> bytes:
         return b"\r\n".join(self.to_lines())
+
+
+class LazyB2FMessage:
+    """
+    A B2F message that parses its headers up front, but only decodes the body and
+    attachments when they are first accessed. Exposes the same attributes as
+    B2FMessage, except that attachment contents are memoryviews rather than bytes.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        header_end = data.find(b"\r\n\r\n")
+        if header_end == -1:
+            header_end = len(data)
+        header_data = data[:header_end]
+        # a view rather than a slice, to avoid copying the body and attachments
+        self._contents = memoryview(data)[header_end + 4 :]
+
+        # keyed by casefolded name, with the first-seen casing kept for extra_headers
+        self._headers: dict[str, list[str]] = {}
+        self._header_names: dict[str, str] = {}
+        for line in header_data.decode("ascii").split("\r\n"):
+            k, _, v = line.partition(": ")
+            key = k.casefold()
+            if key in self._headers:
+                self._headers[key].append(v)
+            else:
+                self._headers[key] = [v]
+                self._header_names[key] = k
+
+    def _get_single_header(self, name: str) -> str:
+        header = self._headers[name]
+        assert len(header) == 1
+        return header[0]
+
+    @property
+    def mid(self) -> str:
+        return self._get_single_header("mid")
+
+    @property
+    def date(self) -> datetime.datetime:
+        return parse_b2f_date(self._get_single_header("date"))
+
+    @property
+    def type(self) -> str | None:
+        if "type" in self._headers:
+            return self._get_single_header("type")
+        return None
+
+    @property
+    def from_(self) -> str:
+        return self._get_single_header("from")
+
+    @property
+    def to(self) -> list[str]:
+        return self._headers["to"]
+
+    @property
+    def cc(self) -> list[str]:
+        return self._headers.get("cc", [])
+
+    @property
+    def subject(self) -> str:
+        return self._get_single_header("subject")
+
+    @property
+    def mbo(self) -> str:
+        return self._get_single_header("mbo")
+
+    @functools.cached_property
+    def extra_headers(self) -> dict[str, list[str]]:
+        return {
+            self._header_names[k]: v
+            for k, v in self._headers.items()
+            if k not in KNOWN_B2F_HEADERS
+        }
+
+    @functools.cached_property
+    def body(self) -> str:
+        content_type = (
+            self._get_single_header("content-type")
+            if "content-type" in self._headers
+            else "iso-8859-1"
+        )
+        return str(self._contents[: self._body_length], content_type)
+
+    @functools.cached_property
+    def files(self) -> list[tuple[str, memoryview]]:
+        # files are separated by "\r\n" (2 bytes)
+        file_offset = self._body_length + 2
+        files = []
+        for file_entry in self._headers.get("file", []):
+            file_len, _, file_name = file_entry.partition(" ")
+            file_end = file_offset + int(file_len)
+            files.append((file_name, self._contents[file_offset:file_end]))
+            file_offset = file_end + 2
+        return files
+
+    @property
+    def _body_length(self) -> int:
+        return int(self._get_single_header("body"))
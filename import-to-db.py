@@ -1,16 +1,57 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import datetime
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import cast
+from typing import TypeVar, cast
 
 import psycopg
-from psycopg.types.json import Jsonb
+from psycopg.types.json import Jsonb, set_json_dumps
 
-from b2f import B2FMessage
+from b2f import LazyB2FMessage
+
+# use orjson's much faster encoder for jsonb columns, if it's installed
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    set_json_dumps(orjson.dumps)
+
+
+# Extracts RMS Express form data from inserted or updated attachments. Each form's
+# XML is parsed once, and the parameters and variables are aggregated separately
+# rather than from the cross product of the two. Forms that can't be parsed get
+# NULL parameters and variables instead of failing the import.
+FORM_DATA_INSERT = """
+    INSERT INTO form_data (
+        attachment_id, message_id, form_filename, parameters, variables
+    )
+    SELECT
+        attachment.id,
+        attachment.message_id,
+        substring(attachment.name, 'RMS_Express_Form_(.*).xml'),
+        form.parameters,
+        form.variables
+    FROM
+        {attachments} AS attachment,
+        parse_form_data(attachment.content) AS form
+    WHERE
+        attachment.name LIKE 'RMS_Express_Form_%.xml'
+        AND NOT EXISTS (
+            SELECT FROM form_data WHERE form_data.attachment_id = attachment.id
+        )
+"""
 
 
 def init_db(conn: psycopg.Connection) -> None:
-    with conn.cursor() as cur:
+    with conn.pipeline(), conn.cursor() as cur:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS message (
                 mid varchar(12) PRIMARY KEY,
@@ -37,33 +78,122 @@ def init_db(conn: psycopg.Connection) -> None:
             )
             """)
 
+        # form_data used to be a view, which re-parsed every form on each query
         cur.execute("""
-            CREATE OR REPLACE VIEW form_data AS
-                SELECT
-                    attachment.message_id,
-                    substring(attachment.name, 'RMS_Express_Form_(.*).xml') AS form_filename,
-                    jsonb_object_agg(parameters.var_name, parameters.value) AS parameters,
-                    jsonb_object_agg(variables.var_name, variables.value) AS variables
-                FROM
-                    attachment,
-                    xmltable('/RMS_Express_Form/form_parameters/*'
-                        passing (convert_from(attachment.content, 'UTF8')::xml)
-                        columns
-                            var_name text path 'name()',
-                            value text path '.'
-                    ) AS parameters,
-                    xmltable('/RMS_Express_Form/variables/*'
-                        passing (convert_from(attachment.content, 'UTF8')::xml)
-                        columns
-                            var_name text path 'name()',
-                            value text path '.'
-                    ) AS variables
-                WHERE
-                    attachment.name LIKE 'RMS_Express_Form_%.xml'
-                GROUP BY
-                    message_id,
-                    attachment.name;
-        """)
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT FROM pg_views
+                    WHERE schemaname = current_schema() AND viewname = 'form_data'
+                ) THEN
+                    DROP VIEW form_data;
+                END IF;
+            END
+            $$;
+            """)
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS form_data (
+                attachment_id integer PRIMARY KEY,
+                message_id varchar(12) NOT NULL,
+                form_filename text,
+                parameters jsonb,
+                variables jsonb,
+                CONSTRAINT fk_attachment FOREIGN KEY (attachment_id) REFERENCES attachment (id)
+                    ON DELETE CASCADE,
+                CONSTRAINT fk_message FOREIGN KEY (message_id) REFERENCES message (mid)
+                    ON DELETE CASCADE
+            )
+            """)
+
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS attachment_form_idx ON attachment (id)
+                WHERE name LIKE 'RMS_Express_Form_%.xml'
+            """)
+
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION form_xml_to_jsonb(form xml, path text)
+                RETURNS jsonb
+                LANGUAGE sql IMMUTABLE
+            AS $$
+                SELECT coalesce(jsonb_object_agg(var_name, value), jsonb_build_object())
+                FROM xmltable(path
+                    passing form
+                    columns
+                        var_name text path 'name()',
+                        value text path '.'
+                )
+            $$
+            """)
+
+        # invalid XML or encoding, or a server built without libxml, must not abort
+        # the whole COPY that fired the trigger
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION parse_form_data(
+                content bytea, OUT parameters jsonb, OUT variables jsonb
+            )
+                LANGUAGE plpgsql STABLE
+            AS $$
+            DECLARE
+                form xml;
+            BEGIN
+                form := convert_from(content, 'UTF8')::xml;
+                parameters := form_xml_to_jsonb(form, '/RMS_Express_Form/form_parameters/*');
+                variables := form_xml_to_jsonb(form, '/RMS_Express_Form/variables/*');
+            EXCEPTION WHEN others THEN
+                parameters := NULL;
+                variables := NULL;
+            END
+            $$
+            """)
+
+        cur.execute(f"""
+            CREATE OR REPLACE FUNCTION insert_form_data()
+                RETURNS trigger
+                LANGUAGE plpgsql
+            AS $$
+            BEGIN
+                {FORM_DATA_INSERT.format(attachments="new_attachment")};
+                RETURN NULL;
+            END
+            $$
+            """)
+
+        # CREATE OR REPLACE TRIGGER needs PostgreSQL 14
+        cur.execute("DROP TRIGGER IF EXISTS insert_form_data ON attachment")
+        cur.execute("""
+            CREATE TRIGGER insert_form_data
+                AFTER INSERT ON attachment
+                REFERENCING NEW TABLE AS new_attachment
+                FOR EACH STATEMENT
+                EXECUTE FUNCTION insert_form_data()
+            """)
+
+        # transition tables can't be combined with a column list, so updates are
+        # handled per row
+        cur.execute(f"""
+            CREATE OR REPLACE FUNCTION update_form_data()
+                RETURNS trigger
+                LANGUAGE plpgsql
+            AS $$
+            BEGIN
+                DELETE FROM form_data WHERE attachment_id = OLD.id;
+                {FORM_DATA_INSERT.format(attachments="(SELECT NEW.*)")};
+                RETURN NULL;
+            END
+            $$
+            """)
+
+        cur.execute("DROP TRIGGER IF EXISTS update_form_data ON attachment")
+        cur.execute("""
+            CREATE TRIGGER update_form_data
+                AFTER UPDATE OF message_id, name, content ON attachment
+                FOR EACH ROW
+                EXECUTE FUNCTION update_form_data()
+            """)
+
+        # fill in forms imported before the trigger existed
+        cur.execute(FORM_DATA_INSERT.format(attachments="attachment"))
 
         cur.execute("""
             CREATE TABLE IF NOT EXISTS message_annotation (
@@ -75,41 +205,141 @@ def init_db(conn: psycopg.Connection) -> None:
         """)
 
 
-def parse_file(conn: psycopg.Connection, filepath: Path):
+BATCH_SIZE = 10_000
+
+T = TypeVar("T")
+
+COPY_MESSAGE = """
+    COPY message (
+        original, mid, date, type, "from", "to", cc, subject, mbo, body, extra_headers
+    )
+    FROM STDIN
+"""
+COPY_ATTACHMENT = "COPY attachment (message_id, name, content) FROM STDIN"
+
+MessageRow = tuple[
+    bytes,
+    str,
+    datetime.datetime,
+    str | None,
+    str,
+    list[str],
+    list[str],
+    str,
+    str,
+    str,
+    dict[str, list[str]],
+]
+AttachmentRow = tuple[str, str, bytes]
+# the message row is None if the message has already been imported
+ParsedFile = tuple[Path, MessageRow | None, list[AttachmentRow]]
+
+# mids of messages already in the database, set in each parse worker
+existing_mids: set[str] = set()
+
+
+def init_parse_worker(mids: set[str]) -> None:
+    global existing_mids
+    existing_mids = mids
+
+
+def parse_file(filepath: Path) -> ParsedFile:
     d = filepath.read_bytes()
-    message = B2FMessage.parse(d)
+    message = LazyB2FMessage(d)
+    # only the headers have been parsed so far, so this is cheap
+    if message.mid in existing_mids:
+        return (filepath, None, [])
+
+    return (
+        filepath,
+        (
+            d,
+            message.mid,
+            message.date,
+            message.type,
+            message.from_,
+            message.to,
+            message.cc,
+            message.subject,
+            message.mbo,
+            message.body,
+            message.extra_headers,
+        ),
+        # memoryviews can't be pickled to send back from the worker process
+        [(message.mid, name, bytes(content)) for name, content in message.files],
+    )
+
 
+def copy_rows(conn: psycopg.Connection, batch: list[ParsedFile]) -> None:
     with conn.transaction(), conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO message (
-                original, mid, date, type, "from", "to", cc, subject, mbo, body, extra_headers
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-            """,
-            (
-                d,
-                message.mid,
-                message.date,
-                message.type,
-                message.from_,
-                message.to,
-                message.cc,
-                message.subject,
-                message.mbo,
-                message.body,
-                Jsonb(message.extra_headers),
-            ),
-        )
+        with cur.copy(COPY_MESSAGE) as copy:
+            for _, message_row, _ in batch:
+                assert message_row is not None
+                *columns, extra_headers = message_row
+                copy.write_row((*columns, Jsonb(extra_headers)))
+
+        with cur.copy(COPY_ATTACHMENT) as copy:
+            for _, _, attachments in batch:
+                for attachment in attachments:
+                    copy.write_row(attachment)
 
-        for name, content in message.files:
-            cur.execute(
-                """
-                INSERT INTO attachment (message_id, name, content)
-                VALUES (%s, %s, %s);
-                """,
-                (message.mid, name, content),
-            )
+
+def import_batch(
+    writers: ThreadPoolExecutor,
+    conns: list[psycopg.Connection],
+    batch: list[ParsedFile],
+    seen_mids: set[str],
+) -> None:
+    # skip messages that are already in the database (filtered out by the parse
+    # workers), or that appeared earlier in this run, e.g. in two files
+    new_messages = []
+    for parsed in batch:
+        message_row = parsed[1]
+        if message_row is None or message_row[1] in seen_mids:
+            continue
+        seen_mids.add(message_row[1])
+        new_messages.append(parsed)
+
+    # split the batch round-robin between the connections, each of which COPYs its
+    # share in its own transaction. A message and its attachments always go to the
+    # same connection, so the foreign key is satisfied within each transaction.
+    shares = [new_messages[i :: len(conns)] for i in range(len(conns))]
+    for _ in writers.map(copy_rows, conns, shares):
+        pass
+
+
+def rename_files(filepaths: list[Path], imported_dir: Path) -> None:
+    for filepath in filepaths:
+        os.replace(filepath, imported_dir / filepath.name)
+
+
+def batched(iterable: Iterable[T], n: int) -> Iterator[list[T]]:
+    # like itertools.batched, which requires Python 3.12
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def parse_batches(
+    pool: multiprocessing.pool.Pool, files: list[Path]
+) -> Iterator[list[ParsedFile]]:
+    # the next batch is parsed while the current one is imported, but no further
+    # ahead, so at most two batches of files are held in memory
+    pending = None
+    for filepaths in batched(files, BATCH_SIZE):
+        parsing = pool.map_async(parse_file, filepaths, chunksize=32)
+        if pending is not None:
+            yield pending.get()
+        pending = parsing
+    if pending is not None:
+        yield pending.get()
+
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
 
 
 def parse_args() -> argparse.Namespace:
@@ -120,6 +350,20 @@ def parse_args() -> argparse.Namespace:
         default=True,
         help="Whether or not to create the required tables and views (default: True)",
     )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=os.cpu_count(),
+        help="Number of processes used to read and parse files; raise this above "
+        "the CPU count if reads are slow, e.g. on network storage "
+        "(default: CPU count)",
+    )
+    parser.add_argument(
+        "--writers",
+        type=positive_int,
+        default=4,
+        help="Number of database connections to COPY into in parallel (default: 4)",
+    )
     parser.add_argument(
         "conninfo",
         help="Postgres connection string (see https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-CONNSTRING)",
@@ -137,15 +381,42 @@ if __name__ == "__main__":
     imported_dir = mailbox_path / "imported"
     imported_dir.mkdir(exist_ok=True)
 
-    with psycopg.connect(args.conninfo, autocommit=True) as conn:
+    with contextlib.ExitStack() as stack:
+        conns = [
+            stack.enter_context(psycopg.connect(args.conninfo, autocommit=True))
+            for _ in range(args.writers)
+        ]
         if args.init_db:
-            init_db(conn)
+            init_db(conns[0])
+
+        with conns[0].cursor() as cur:
+            existing = {mid for (mid,) in cur.execute("SELECT mid FROM message")}
 
-        for f in (mailbox_path).glob("*.b2f"):
-            imported_filename = imported_dir / f.name
-            if imported_filename.exists():
-                raise Exception(
-                    f"File name {f.name} exists in both input and output directories"
+        with os.scandir(mailbox_path) as it:
+            files = [
+                Path(entry.path)
+                for entry in it
+                if entry.name.endswith(".b2f") and entry.is_file()
+            ]
+
+        with (
+            multiprocessing.Pool(args.jobs, init_parse_worker, (existing,)) as pool,
+            ThreadPoolExecutor(args.writers) as writers,
+            ThreadPoolExecutor(1) as renamer,
+        ):
+            renames = []
+            for batch in parse_batches(pool, files):
+                import_batch(writers, conns, batch, existing)
+                # files are moved only once their batch has committed, but can be
+                # moved while the next batch is imported. Files for messages that
+                # were already imported are moved too, replacing any earlier copy.
+                renames.append(
+                    renamer.submit(
+                        rename_files,
+                        [filepath for filepath, _, _ in batch],
+                        imported_dir,
+                    )
                 )
-            parse_file(conn, f)
-            f.rename(imported_filename)
+
+            for rename in renames:
+                rename.result()